@@ -1,30 +1,241 @@
 # app.py
-from flask import Flask, jsonify, abort, send_file
+from flask import Flask, abort, current_app, send_from_directory
 import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+import orjson
+from flask_compress import Compress
 from sqlalchemy import create_engine, text
-from sqlalchemy.engine import URL
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import DBAPIError, OperationalError
+from werkzeug.routing import BaseConverter
 
 _engine = None
+_engine_lock = threading.Lock()
+
+# Seconds a cached term lookup stays valid; <= 0 disables the cache (see cached_lookup)
+TERM_CACHE_TTL = int(os.getenv("TERM_CACHE_TTL", "300"))
+
+# SQL statements, compiled once at import rather than on every request.
+# Coordinate queries tag the probe point with the column's own SRID
+# (Find_SRID is stable, so the GiST index on geom is still used).
+Q_TERM_STUDIES = text("""
+    SELECT DISTINCT study_id
+    FROM ns.annotations_terms
+    WHERE term LIKE :term
+""")
+
+Q_COORD_STUDIES = text("""
+    SELECT DISTINCT study_id
+    FROM ns.coordinates
+    WHERE ST_3DDWithin(geom, ST_SetSRID(ST_MakePoint(:x, :y, :z), Find_SRID('ns', 'coordinates', 'geom')), 0)
+""")
+
+# Both directions of the set difference in one round trip
+Q_DISSOC_COORDS = text("""
+    WITH a AS (
+        SELECT DISTINCT study_id
+        FROM ns.coordinates
+        WHERE ST_3DDWithin(geom, ST_SetSRID(ST_MakePoint(:x1, :y1, :z1), Find_SRID('ns', 'coordinates', 'geom')), 0)
+    ), b AS (
+        SELECT DISTINCT study_id
+        FROM ns.coordinates
+        WHERE ST_3DDWithin(geom, ST_SetSRID(ST_MakePoint(:x2, :y2, :z2), Find_SRID('ns', 'coordinates', 'geom')), 0)
+    )
+    (SELECT 'a' AS side, study_id FROM a EXCEPT SELECT 'a', study_id FROM b)
+    UNION ALL
+    (SELECT 'b' AS side, study_id FROM b EXCEPT SELECT 'b', study_id FROM a)
+""")
+
+# 使用 LIKE 查詢，模糊比對 term（needle 已轉小寫）
+# EXCEPT 以 anti-join 取差集，避免 NOT IN 子查詢
+Q_DISSOC_TERMS = text("""
+    SELECT study_id
+    FROM ns.annotations_terms
+    WHERE term LIKE :term_a
+    EXCEPT
+    SELECT study_id
+    FROM ns.annotations_terms
+    WHERE term LIKE :term_b
+""")
+
+Q_SEARCH_TERM = text("SELECT DISTINCT term FROM ns.annotations_terms WHERE term LIKE :term LIMIT 10")
+
+# GROUP BY 讓 Postgres 用 HashAggregate，而非 COUNT(DISTINCT) 的排序去重
+Q_TERM_COUNT = text("""
+    SELECT COUNT(*) AS study_count
+    FROM (
+        SELECT study_id
+        FROM ns.annotations_terms
+        WHERE term LIKE :term
+        GROUP BY study_id
+    ) AS matched
+""")
+
+# term_studies is the deduped (term, study_id) materialized view built by create_db.py
+Q_INTERSECTION_COUNT = text("""
+    SELECT COUNT(*) AS intersection_count
+    FROM (
+        SELECT study_id
+        FROM ns.term_studies
+        WHERE term LIKE :term_a
+        INTERSECT
+        SELECT study_id
+        FROM ns.term_studies
+        WHERE term LIKE :term_b
+    ) AS intersected
+""")
+
+# /test_db: server version and table counts in one round trip
+Q_TEST_DB_COUNTS = text("""
+    SELECT
+        (SELECT version()) AS version,
+        (SELECT COUNT(*) FROM ns.coordinates) AS coordinates_count,
+        (SELECT COUNT(*) FROM ns.metadata) AS metadata_count,
+        (SELECT COUNT(*) FROM ns.annotations_terms) AS annotations_terms_count
+""")
+
+# /test_db: a few rows from each table, aggregated to JSON arrays in one round trip
+Q_TEST_DB_SAMPLES = text("""
+    WITH c AS (
+        SELECT study_id, ST_X(geom) AS x, ST_Y(geom) AS y, ST_Z(geom) AS z
+        FROM ns.coordinates LIMIT 3
+    ), m AS (
+        SELECT * FROM ns.metadata LIMIT 3
+    ), a AS (
+        SELECT study_id, contrast_id, term, weight
+        FROM ns.annotations_terms LIMIT 3
+    )
+    SELECT
+        (SELECT COALESCE(json_agg(c), '[]'::json) FROM c) AS coordinates_sample,
+        (SELECT COALESCE(json_agg(m), '[]'::json) FROM m) AS metadata_sample,
+        (SELECT COALESCE(json_agg(a), '[]'::json) FROM a) AS annotations_terms_sample
+""")
+
+class CoordsConverter(BaseConverter):
+    """Match an ``x_y_z`` path segment of integers and convert it to a tuple."""
+    regex = r"-?\d+_-?\d+_-?\d+"
+
+    def to_python(self, value):
+        x, y, z = value.split("_")
+        return int(x), int(y), int(z)
+
+    def to_url(self, value):
+        return "_".join(str(int(v)) for v in value)
+
+def like_needle(term):
+    """Build a '%term%' LIKE pattern.
+
+    create_db.py stores terms lowercased, so lowercasing the needle gives
+    case-insensitive matching with plain LIKE against the trigram index.
+    """
+    return f"%{term.lower()}%"
+
+def ojsonify(obj, status=200):
+    """Like flask.jsonify, but serialized with orjson."""
+    return current_app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
 
 def get_engine():
     global _engine
     if _engine is not None:
         return _engine
+    # gthread workers can race on the first requests; build only one engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = _create_engine()
+    return _engine
+
+def _create_engine():
     db_url = os.getenv("DB_URL")
     if not db_url:
         raise RuntimeError("Missing DB_URL (or DATABASE_URL) environment variable.")
     # Normalize old 'postgres://' scheme to 'postgresql://'
     if db_url.startswith("postgres://"):
         db_url = "postgresql://" + db_url[len("postgres://"):]
-    _engine = create_engine(
+    # Use psycopg 3 (server-side prepared statements) unless the URL already
+    # names a driver
+    if db_url.startswith("postgresql://"):
+        db_url = "postgresql+psycopg://" + db_url[len("postgresql://"):]
+    # Set search_path once per connection rather than once per request. The
+    # app only reads, so sessions are read-only (autocommit sends no BEGIN to
+    # carry a per-transaction READ ONLY flag).
+    connect_args = {
+        "application_name": "yomuscle",
+        "options": "-c search_path=ns,public -c default_transaction_read_only=on",
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 3,
+    }
+    if make_url(db_url).get_driver_name() == "psycopg":
+        # PREPARE each statement on a connection the first time it repeats
+        # (psycopg 3 only; libpq/psycopg2 reject the option)
+        connect_args["prepare_threshold"] = 1
+    return create_engine(
         db_url,
-        pool_pre_ping=True,
+        # No SELECT 1 on every checkout; TCP keepalives + recycling detect
+        # dead connections and run_query() retries once if one slips through
+        pool_pre_ping=False,
+        # Size the pool for concurrent gunicorn handlers instead of the default 5
+        pool_size=20,
+        max_overflow=10,
+        pool_recycle=600,
+        pool_use_lifo=True,
+        connect_args=connect_args,
     )
-    return _engine
+
+@contextmanager
+def ro_conn():
+    """Autocommit connection for pure-SELECT work (no BEGIN/COMMIT round trips)."""
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        yield conn
+
+def run_query(fn):
+    """Run ``fn(conn)`` on a read-only connection, retrying once if it was dropped."""
+    for attempt in range(2):
+        try:
+            with ro_conn() as conn:
+                return fn(conn)
+        except DBAPIError as e:
+            if attempt or not e.connection_invalidated:
+                raise
+
+def cached_lookup(fn, *args):
+    """Call an lru_cache'd term lookup with a generation key.
+
+    Annotation data changes only on a reload or a --refresh-views run, so term
+    lookups are cached per process. The generation rolls every TERM_CACHE_TTL
+    seconds, which bounds staleness and lets old entries age out of the LRU.
+    A TTL <= 0 bypasses the cache entirely.
+    """
+    if TERM_CACHE_TTL <= 0:
+        return fn.__wrapped__(*args, None)
+    return fn(*args, int(time.time() // TERM_CACHE_TTL))
+
+# Cached per process, keyed on the lowercased term and generation (see cached_lookup).
+@lru_cache(maxsize=4096)
+def _search_term_impl(term_lower, generation):
+    return run_query(lambda conn: tuple(
+        conn.execute(Q_SEARCH_TERM, {"term": like_needle(term_lower)}).scalars()
+    ))
+
+@lru_cache(maxsize=4096)
+def _term_count_impl(term_lower, generation):
+    return run_query(lambda conn: conn.execute(
+        Q_TERM_COUNT, {"term": like_needle(term_lower)}
+    ).scalar()) or 0
 
 def create_app():
     app = Flask(__name__)
+    app.url_map.converters["coords"] = CoordsConverter
+
+    # Compress JSON responses (large study_id arrays) for clients that accept it
+    app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+    app.config["COMPRESS_MIN_SIZE"] = 1024
+    Compress(app)
 
     @app.get("/", endpoint="health")
     def health():
@@ -32,52 +243,42 @@ def create_app():
 
     @app.get("/img", endpoint="show_img")
     def show_img():
-        return send_file("amygdala.gif", mimetype="image/gif")
+        # ETag + Last-Modified let repeat requests come back as 304s
+        return send_from_directory(
+            app.root_path, "amygdala.gif",
+            mimetype="image/gif", max_age=86400, conditional=True, etag=True
+        )
 
     @app.get("/terms/<term>/studies", endpoint="terms_studies")
     def get_studies_by_term(term):
         # 將底線換成空格
         term = term.replace("_", " ")
-        eng = get_engine()
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                query = text("""
-                    SELECT DISTINCT study_id
-                    FROM ns.annotations_terms
-                    WHERE term LIKE :term
-                """)
-                rows = conn.execute(query, {"term": f"%{term}%"}).mappings().all()
-                studies = [row["study_id"] for row in rows]
-            return jsonify({
+            studies = run_query(lambda conn: conn.execute(
+                Q_TERM_STUDIES, {"term": like_needle(term)}
+            ).scalars().all())
+            return ojsonify({
                 "term": term,
                 "study_count": len(studies),
                 "studies": studies
-            }), 200
+            }, 200)
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return ojsonify({"error": str(e)}, 500)
 
-    @app.get("/locations/<coords>/studies", endpoint="locations_studies")
+    @app.get("/locations/<coords:coords>/studies", endpoint="locations_studies")
     def get_studies_by_coordinates(coords):
-        x, y, z = map(int, coords.split("_"))
-        eng = get_engine()
+        x, y, z = coords
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                query = text("""
-                    SELECT DISTINCT study_id
-                    FROM ns.coordinates
-                    WHERE ST_X(geom) = :x AND ST_Y(geom) = :y AND ST_Z(geom) = :z
-                """)
-                rows = conn.execute(query, {"x": x, "y": y, "z": z}).mappings().all()
-                studies = [row["study_id"] for row in rows]
-            return jsonify({
+            studies = run_query(lambda conn: conn.execute(Q_COORD_STUDIES, {
+                "x": float(x), "y": float(y), "z": float(z)
+            }).scalars().all())
+            return ojsonify({
                 "coordinates": [x, y, z],
                 "study_count": len(studies),
                 "studies": studies
-            }), 200
+            }, 200)
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return ojsonify({"error": str(e)}, 500)
 
     @app.get("/test_db", endpoint="test_db")
     
@@ -86,86 +287,51 @@ def create_app():
         payload = {"ok": False, "dialect": eng.dialect.name}
 
         try:
-            with eng.begin() as conn:
-                # Ensure we are in the correct schema
-                conn.execute(text("SET search_path TO ns, public;"))
-                payload["version"] = conn.exec_driver_sql("SELECT version()").scalar()
-
-                # Counts
-                payload["coordinates_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.coordinates")).scalar()
-                payload["metadata_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.metadata")).scalar()
-                payload["annotations_terms_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.annotations_terms")).scalar()
+            with ro_conn() as conn:
+                # Version + counts
+                payload.update(conn.execute(Q_TEST_DB_COUNTS).mappings().one())
 
                 # Samples
                 try:
-                    rows = conn.execute(text(
-                        "SELECT study_id, ST_X(geom) AS x, ST_Y(geom) AS y, ST_Z(geom) AS z FROM ns.coordinates LIMIT 3"
-                    )).mappings().all()
-                    payload["coordinates_sample"] = [dict(r) for r in rows]
+                    payload.update(conn.execute(Q_TEST_DB_SAMPLES).mappings().one())
                 except Exception:
                     payload["coordinates_sample"] = []
-
-                try:
-                    # Select a few columns if they exist; otherwise select a generic subset
-                    rows = conn.execute(text("SELECT * FROM ns.metadata LIMIT 3")).mappings().all()
-                    payload["metadata_sample"] = [dict(r) for r in rows]
-                except Exception:
                     payload["metadata_sample"] = []
-
-                try:
-                    rows = conn.execute(text(
-                        "SELECT study_id, contrast_id, term, weight FROM ns.annotations_terms LIMIT 3"
-                    )).mappings().all()
-                    payload["annotations_terms_sample"] = [dict(r) for r in rows]
-                except Exception:
                     payload["annotations_terms_sample"] = []
 
             payload["ok"] = True
-            return jsonify(payload), 200
+            return ojsonify(payload, 200)
 
         except Exception as e:
             payload["error"] = str(e)
-            return jsonify(payload), 500
+            return ojsonify(payload, 500)
 
-    @app.get("/dissociate/locations/<coords1>/<coords2>", endpoint="dissociate_locations")
+    @app.get("/dissociate/locations/<coords:coords1>/<coords:coords2>", endpoint="dissociate_locations")
     def dissociate_locations(coords1, coords2):
         try:
-            # Parse the coordinates
-            x1, y1, z1 = map(int, coords1.split("_"))
-            x2, y2, z2 = map(int, coords2.split("_"))
-
-            eng = get_engine()
-            with eng.begin() as conn:
-                # Query for studies mentioning the first set of coordinates
-                query1 = text("""
-                    SELECT DISTINCT study_id
-                    FROM ns.coordinates
-                    WHERE ST_X(geom) = :x1 AND ST_Y(geom) = :y1 AND ST_Z(geom) = :z1
-                """)
-                studies1 = {row["study_id"] for row in conn.execute(query1, {"x1": x1, "y1": y1, "z1": z1}).mappings()}
-
-                # Query for studies mentioning the second set of coordinates
-                query2 = text("""
-                    SELECT DISTINCT study_id
-                    FROM ns.coordinates
-                    WHERE ST_X(geom) = :x2 AND ST_Y(geom) = :y2 AND ST_Z(geom) = :z2
-                """)
-                studies2 = {row["study_id"] for row in conn.execute(query2, {"x2": x2, "y2": y2, "z2": z2}).mappings()}
-
-            # Find studies that mention the first set but not the second
-            a_to_b = list(studies1 - studies2)
-
-            # Find studies that mention the second set but not the first
-            b_to_a = list(studies2 - studies1)
+            # Coordinates are parsed by CoordsConverter
+            x1, y1, z1 = coords1
+            x2, y2, z2 = coords2
+
+            rows = run_query(lambda conn: conn.execute(Q_DISSOC_COORDS, {
+                "x1": float(x1), "y1": float(y1), "z1": float(z1),
+                "x2": float(x2), "y2": float(y2), "z2": float(z2)
+            }).all())
+
+            # Split by side in one pass over plain row tuples:
+            # a_to_b = coords1 but not coords2, b_to_a = coords2 but not coords1
+            a_to_b, b_to_a = [], []
+            for side, study_id in rows:
+                (a_to_b if side == "a" else b_to_a).append(study_id)
 
             # Return both directions in one response
-            return jsonify({
+            return ojsonify({
                 "a_to_b": a_to_b,  # Studies mentioning coords1 but not coords2
                 "b_to_a": b_to_a   # Studies mentioning coords2 but not coords1
-            }), 200
+            }, 200)
 
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return ojsonify({"error": str(e)}, 500)
 
     @app.get("/dissociate/terms/<term_a>/<term_b>", endpoint="dissociate_terms")
     def dissociate_terms(term_a, term_b):
@@ -173,112 +339,65 @@ def create_app():
         term_a = term_a.replace("_", " ")
         term_b = term_b.replace("_", " ")
         try:
-            eng = get_engine()
-            with eng.begin() as conn:
-                # 確保使用正確的 schema
-                conn.execute(text("SET search_path TO ns, public;"))
-                # 使用 LIKE 查詢，模糊比對 term
-                query = text("""
-                    SELECT DISTINCT study_id
-                    FROM ns.annotations_terms
-                    WHERE term LIKE :term_a
-                      AND study_id NOT IN (
-                          SELECT study_id
-                          FROM ns.annotations_terms
-                          WHERE term LIKE :term_b
-                      );
-                """)
-                studies = [row["study_id"] for row in conn.execute(
-                    query,
-                    {"term_a": f"%{term_a}%", "term_b": f"%{term_b}%"
-                }).mappings()]
+            studies = run_query(lambda conn: conn.execute(Q_DISSOC_TERMS, {
+                "term_a": like_needle(term_a),
+                "term_b": like_needle(term_b)
+            }).scalars().all())
             # 返回結果，包含 study_count 欄位
-            return jsonify({
+            return ojsonify({
                 "study_count": len(studies),
                 "dissociated_studies": studies
-            }), 200
+            }, 200)
 
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return ojsonify({"error": str(e)}, 500)
 
     @app.get("/search_term/<term>", endpoint="search_term")
     def search_term(term):
-        eng = get_engine()
         result = {
             "term": term,
             "exists": False,
             "matches": []
         }
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                # 查詢 term 是否存在
-                rows = conn.execute(
-                    text("SELECT DISTINCT term FROM ns.annotations_terms WHERE term ILIKE :term LIMIT 10"),
-                    {"term": f"%{term}%"
-                }).mappings().all()
-                result["matches"] = [row["term"] for row in rows]
-                result["exists"] = len(result["matches"]) > 0
-            return jsonify(result), 200
+            # 查詢 term 是否存在
+            result["matches"] = cached_lookup(_search_term_impl, term.lower())
+            result["exists"] = len(result["matches"]) > 0
+            return ojsonify(result, 200)
         except Exception as e:
             result["error"] = str(e)
-            return jsonify(result), 500
+            return ojsonify(result, 500)
 
     @app.get("/terms/<term>/count", endpoint="term_count")
     def term_count(term):
         # 自動將底線換成空格
         term = term.replace("_", " ")
-        eng = get_engine()
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                query = text("""
-                    SELECT COUNT(DISTINCT study_id) AS study_count
-                    FROM ns.annotations_terms
-                    WHERE term LIKE :term
-                """)
-                result = conn.execute(query, {"term": f"%{term}%"}).mappings().first()
-                count = result["study_count"] if result else 0
-            return jsonify({
+            count = cached_lookup(_term_count_impl, term.lower())
+            return ojsonify({
                 "term": term,
                 "study_count": count
-            }), 200
+            }, 200)
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return ojsonify({"error": str(e)}, 500)
 
     @app.get("/terms/<term_a>/<term_b>/intersection_count", endpoint="intersection_count")
     def intersection_count(term_a, term_b):
         # 將底線換成空格
         term_a = term_a.replace("_", " ")
         term_b = term_b.replace("_", " ")
-        eng = get_engine()
         try:
-            with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                query = text("""
-                    SELECT COUNT(*) AS intersection_count
-                    FROM (
-                        SELECT study_id
-                        FROM ns.annotations_terms
-                        WHERE term LIKE :term_a
-                        INTERSECT
-                        SELECT study_id
-                        FROM ns.annotations_terms
-                        WHERE term LIKE :term_b
-                    ) AS intersected
-                """)
-                result = conn.execute(query, {
-                    "term_a": f"%{term_a}%",
-                    "term_b": f"%{term_b}%"
-                }).mappings().first()
-                count = result["intersection_count"] if result else 0
-            return jsonify({
+            count = run_query(lambda conn: conn.execute(Q_INTERSECTION_COUNT, {
+                "term_a": like_needle(term_a),
+                "term_b": like_needle(term_b)
+            }).scalar()) or 0
+            return ojsonify({
                 "intersection_count": count,
                 "term_a": term_a,
                 "term_b": term_b
-            }), 200
+            }, 200)
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            return ojsonify({"error": str(e)}, 500)
 
     return app
 
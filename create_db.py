@@ -5,7 +5,8 @@
 PostgreSQL loader (accelerated) with:
 - PostGIS POINTZ geometry (+ GIST) for coordinates
 - FTS (tsvector) + trigger (+ GIN) for metadata
-- Fast annotations_terms via NumPy + COPY
+- Fast annotations_terms via NumPy + COPY (+ pg_trgm GIN on term)
+- term_studies materialized view (deduped term x study_id) for intersections
 - Optional annotations_json aggregation (+ GIN) via --enable-json
 
 Default schema: ns
@@ -36,6 +37,8 @@ def parse_args():
     ap.add_argument("--stage-chunksize", type=int, default=50000, help="pandas.to_sql() chunksize for staging loads")
     ap.add_argument("--enable-json", action="store_true", help="Also build annotations_json (slow)")
     ap.add_argument("--srid", type=int, default=4326, help="SRID for geometry(POINTZ). Default 4326")
+    ap.add_argument("--refresh-views", action="store_true",
+                    help="Only create/REFRESH the term_studies materialized view (e.g. nightly) and exit")
     return ap.parse_args()
 
 
@@ -261,6 +264,9 @@ def build_annotations(engine: Engine, df: pd.DataFrame, schema: str, batch_cols:
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term ON {schema}.annotations_terms (term);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_study ON {schema}.annotations_terms (study_id);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_study ON {schema}.annotations_terms (term, study_id);"))
+        # Trigram GIN so the API's '%term%' LIKE lookups can use an index
+        # (terms are stored lowercased above, so the API lowercases its needle)
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_trgm ON {schema}.annotations_terms USING GIN (term gin_trgm_ops);"))
         conn.execute(text(f"ANALYZE {schema}.annotations_terms;"))
         # Build PK/unique AFTER load to avoid per-row maintenance
         conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_annotations_terms ON {schema}.annotations_terms (study_id, contrast_id, term);"))
@@ -287,6 +293,43 @@ def build_annotations(engine: Engine, df: pd.DataFrame, schema: str, batch_cols:
     print("   … annotations done.")
 
 
+# -----------------------------
+# term_studies materialized view (deduped term x study_id)
+# -----------------------------
+def build_term_studies(engine: Engine, schema: str):
+    print("→ term_studies: building materialized view")
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {schema}.term_studies;"))
+        conn.execute(text(f"""
+            CREATE MATERIALIZED VIEW {schema}.term_studies AS
+            SELECT term, study_id
+            FROM {schema}.annotations_terms
+            GROUP BY term, study_id;
+        """))
+        # Unique index is required for REFRESH ... CONCURRENTLY
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_term_studies ON {schema}.term_studies (term, study_id);"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_term_studies_term_trgm ON {schema}.term_studies USING GIN (term gin_trgm_ops);"))
+        conn.execute(text(f"ANALYZE {schema}.term_studies;"))
+    print("→ term_studies done.")
+
+
+def refresh_term_studies(engine: Engine, schema: str):
+    # Bring databases loaded before the trigram index / term_studies existed up to date
+    ensure_extensions(engine)
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_trgm ON {schema}.annotations_terms USING GIN (term gin_trgm_ops);"))
+        exists = conn.execute(text("SELECT to_regclass(:name) IS NOT NULL;"), {"name": f"{schema}.term_studies"}).scalar()
+    if not exists:
+        build_term_studies(engine, schema)
+        return
+
+    # CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {schema}.term_studies;"))
+        conn.execute(text(f"ANALYZE {schema}.term_studies;"))
+    print(f"✅ refreshed {schema}.term_studies")
+
+
 # -----------------------------
 # Main
 # -----------------------------
@@ -294,6 +337,10 @@ def main():
     args = parse_args()
     engine = create_engine(args.url, pool_pre_ping=True)
 
+    if args.refresh_views:
+        refresh_term_studies(engine, args.schema)
+        return
+
     ensure_schema(engine, args.schema)
     ensure_extensions(engine)
 
@@ -322,11 +369,13 @@ def main():
 
     print("\n=== Build: annotations ===")
     build_annotations(engine, ann, args.schema, args.batch_cols, enable_json=args.enable_json)
+    build_term_studies(engine, args.schema)
 
     print("\n=== Ready ===")
     print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + GIST)")
     print(f"- metadata     : {args.schema}.metadata (FTS + trigger + GIN)")
-    print(f"- annotations  : {args.schema}.annotations_terms (sparse via COPY)" + (" + annotations_json (GIN)" if args.enable_json else ""))
+    print(f"- annotations  : {args.schema}.annotations_terms (sparse via COPY + trigram GIN)" + (" + annotations_json (GIN)" if args.enable_json else ""))
+    print(f"- term_studies : {args.schema}.term_studies (materialized view, refresh with --refresh-views)")
 
 
 if __name__ == "__main__":
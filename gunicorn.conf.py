@@ -0,0 +1,17 @@
+# gunicorn.conf.py
+# Loaded automatically by `gunicorn app:app` when started from this directory.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Handlers spend most of their time waiting on Postgres, and psycopg releases
+# the GIL while it waits, so threaded workers overlap many requests per process.
+# Keep workers * threads within the SQLAlchemy pool (pool_size + max_overflow
+# per process) configured in app.get_engine().
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, 4)))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+timeout = 60
+keepalive = 5